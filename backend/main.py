@@ -1,20 +1,33 @@
 import os
-import random
-import json
+import base64
+import hashlib
+import uuid
+import itertools
+import orjson
 import asyncio
+import random
+import numpy as np
 from datetime import datetime, timezone
 from typing import Optional, List
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Body, Depends
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Body, Depends, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 
 # --- Database Imports ---
-from sqlalchemy import create_engine, Column, Integer, Float, DateTime, text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import Column, Integer, Float, DateTime, Index, text, select, insert, delete, func, tuple_, case, or_, bindparam, event, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import StaticPool
+
+# --- Cache Imports ---
+from cachetools import TLRUCache
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
 # --- AI Imports ---
 import google.generativeai as genai
@@ -30,30 +43,106 @@ except Exception as e:
     print(f"Failed to configure Google Generative AI: {e}")
     model = None
 
-# --- SQLAlchemy / In-Memory SQLite Setup ---
-# Use an in-memory SQLite database which is reset on every application restart.
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+# --- SQLAlchemy / Async Engine Setup ---
+# DATABASE_URL selects the database. Postgres URLs are routed through the asyncpg
+# driver; without it we fall back to an in-memory SQLite database (via aiosqlite)
+# which is reset on every application restart.
+# Sync driver URLs (as handed out by hosting providers or older configs) are mapped
+# onto their async drivers, since create_async_engine rejects blocking DBAPIs.
+ASYNC_DRIVER_PREFIXES = {
+    "postgres://": "postgresql+asyncpg://",
+    "postgresql://": "postgresql+asyncpg://",
+    "postgresql+psycopg2://": "postgresql+asyncpg://",
+    "sqlite://": "sqlite+aiosqlite://",
+    "sqlite+pysqlite://": "sqlite+aiosqlite://",
+}
+
+def to_async_database_url(url: str) -> str:
+    for prefix, async_prefix in ASYNC_DRIVER_PREFIXES.items():
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+SQLALCHEMY_DATABASE_URL = to_async_database_url(
+    os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+)
+# Applied to every new SQLite connection. WAL lets readers proceed while /generate
+# writes, and synchronous=NORMAL drops the fsync on every commit (WAL stays consistent
+# across crashes). An in-memory database ignores the journal settings.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+def is_memory_sqlite(url: str) -> bool:
+    return url.startswith("sqlite") and make_url(url).database in (None, "", ":memory:")
+
+def make_engine(url: str):
+    if url.startswith("sqlite"):
+        engine_options = {"connect_args": {"check_same_thread": False}}
+        if is_memory_sqlite(url):
+            # A single shared connection keeps the in-memory database alive across requests
+            engine_options["poolclass"] = StaticPool
+    else:
+        # Long-lived queue pool shared by all requests: 20 connections plus 10 overflow for
+        # bursts. Connections are pinged on checkout and recycled hourly, so ones dropped by
+        # PgBouncer/Postgres are replaced transparently instead of failing a request.
+        engine_options = {
+            "pool_size": 20,
+            "max_overflow": 10,
+            "pool_timeout": 30,
+            "pool_pre_ping": True,
+            "pool_recycle": 3600,
+        }
+    engine = create_async_engine(url, **engine_options)
+    if url.startswith("sqlite"):
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    return engine
+
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+# In-memory SQLite runs every session on the one StaticPool connection. Returning it to
+# the pool issues a ROLLBACK, which would undo whatever transaction another session has
+# open on it, so database work there takes turns: one session or connection at a time.
+# With a real pool each session has its own connection and this is a no-op.
+db_lock = asyncio.Lock() if is_memory_sqlite(SQLALCHEMY_DATABASE_URL) else None
+
+@asynccontextmanager
+async def serialized():
+    if db_lock is None:
+        yield
+        return
+    async with db_lock:
+        yield
 Base = declarative_base()
 
 class GridDataModel(Base):
     __tablename__ = "grid_data"
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    # Callable so the default is taken per insert, not once at import time
+    timestamp = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     voltage = Column(Float)
     current = Column(Float)
     frequency = Column(Float, nullable=True)
 
+# Newest-first index matching the (timestamp DESC, id DESC) ordering of the read
+# endpoints, so ORDER BY ... LIMIT and time-range filters are bounded index scans.
+# Keep in sync with db/init.sql.
+Index("idx_grid_data_ts_desc", GridDataModel.timestamp.desc(), GridDataModel.id.desc())
+
 # Function to get a database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with serialized(), SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # FastAPI application lifecycle management
 # We use this to run code when the app starts up and shuts down
@@ -61,31 +150,38 @@ def get_db():
 async def lifespan(app: FastAPI):
     # This code runs on startup
     print("Creating tables and inserting initial data...")
-    Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
-    try:
-        # Insert initial data
-        initial_records = [
-            GridDataModel(voltage=230.1, current=10.5, frequency=50.0),
-            GridDataModel(voltage=231.5, current=12.1, frequency=50.1),
-            GridDataModel(voltage=229.8, current=9.7, frequency=49.9),
-        ]
-        db.add_all(initial_records)
-        db.commit()
-        print("Initial data inserted successfully.")
-    except Exception as e:
-        print(f"Failed to insert initial data: {e}")
-        db.rollback()
-    finally:
-        db.close()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with SessionLocal() as db:
+        try:
+            # Insert initial data, unless a persistent database (Postgres) already has rows
+            if not await db.scalar(select(func.count()).select_from(GridDataModel)):
+                initial_records = [
+                    GridDataModel(voltage=230.1, current=10.5, frequency=50.0),
+                    GridDataModel(voltage=231.5, current=12.1, frequency=50.1),
+                    GridDataModel(voltage=229.8, current=9.7, frequency=49.9),
+                ]
+                db.add_all(initial_records)
+                await db.commit()
+                print("Initial data inserted successfully.")
+        except Exception as e:
+            print(f"Failed to insert initial data: {e}")
+            await db.rollback()
+    relay = asyncio.create_task(relay_broadcasts()) if redis_client is not None else None
     yield
     # This code runs on shutdown
+    if relay is not None:
+        relay.cancel()
+    if redis_client is not None:
+        await redis_client.aclose()
+    await engine.dispose()
     print("Application shutting down.")
 
 app = FastAPI(
     title="Grid Data API",
     description="API for simulating and retrieving grid data.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan # Link the lifespan function to the app
 )
 
@@ -108,8 +204,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Has-More"],
 )
 
+# --- Compression Middleware ---
+# Record JSON repeats the same keys on every row and compresses several-fold; bodies
+# under 1KB aren't worth the CPU. Level 5 keeps most of the ratio at a fraction of the
+# cost of the default 9. WebSocket frames are compressed separately by uvicorn's
+# permessage-deflate, which is negotiated by default.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Set on live-streamed responses that must reach the client chunk by chunk; GZip holds
+# small writes in its compressor and would otherwise delay them until the stream ends.
+UNCOMPRESSED_STREAM_HEADERS = {"Content-Encoding": "identity"}
+
 class GridData(BaseModel):
     id: int
     timestamp: datetime
@@ -119,127 +227,668 @@ class GridData(BaseModel):
     class Config:
         from_attributes = True
 
-class NewGridDataResponse(BaseModel):
+class GenerationJobResponse(BaseModel):
     message: str
-    rows_inserted: int
+    job_id: str
+
+class StatsResponse(BaseModel):
+    record_count: int
+    average_voltage: Optional[float] = None
+    min_voltage: Optional[float] = None
+    max_voltage: Optional[float] = None
+    average_current: Optional[float] = None
+    min_current: Optional[float] = None
+    max_current: Optional[float] = None
+    anomalous_records: int
+
+# Anomaly thresholds shared by /data/stats, the report summary and the prompt text
+VOLTAGE_LOW_THRESHOLD = 215.0
+VOLTAGE_HIGH_THRESHOLD = 245.0
+CURRENT_HIGH_THRESHOLD = 20.0
+
+# The read paths select these columns as plain Core rows rather than ORM entities, so
+# no instances are hydrated or tracked by the session. Rows are already well-typed,
+# so they skip Pydantic validation too and go straight to orjson as dicts.
+RECORD_COLUMNS = (
+    GridDataModel.id,
+    GridDataModel.timestamp,
+    GridDataModel.voltage,
+    GridDataModel.current,
+    GridDataModel.frequency,
+)
+
+def serialize_records(rows) -> bytes:
+    return orjson.dumps([row._asdict() for row in rows])
+
+# Read endpoints return at most MAX_LIMIT rows. They fetch one extra row to report
+# X-Has-More without a COUNT(*).
+MAX_LIMIT = 1000
+LIMIT_DESCRIPTION = f"Number of records to return (1-{MAX_LIMIT})."
+
+# Cached responses are stored as one line of JSON-encoded headers followed by the body
+def pack_response(headers: dict, payload: bytes) -> bytes:
+    return orjson.dumps(headers) + b"\n" + payload
+
+def unpack_response(cached: bytes) -> Response:
+    headers, _, payload = cached.partition(b"\n")
+    return Response(content=payload, media_type="application/json", headers=orjson.loads(headers))
+
+# --- Response Cache ---
+# Serialized responses keyed on their query params, in two tiers:
+# - an in-process TLRU cache in front of everything.
+# - Redis when REDIS_URL is set, shared across workers. Local entries then live at
+#   most local_ttl seconds, which bounds how stale other workers' copies can get.
+# Both tiers file entries under a generation number, so invalidation is a single
+# increment and stale entries just age out. With Redis the generation is a shared
+# counter (INCR on clear), read again on every local miss, so a clear on one worker
+# reaches the others' Redis reads immediately. The counter has no TTL and must never be
+# evicted (a reset would reuse generations whose entries may still be live), so Redis
+# runs with volatile-lfu and every cached value is written with an expiry.
+# Cache errors are treated as misses so Redis is never required.
+LOCAL_TTL = 2
+
+class ResponseCache:
+    def __init__(
+        self,
+        redis: Optional[aioredis.Redis] = None,
+        prefix: str = "grid",
+        maxsize: int = 1024,
+        local_ttl: int = LOCAL_TTL,
+    ):
+        self.redis = redis
+        self.prefix = prefix
+        self.local_ttl = local_ttl
+        self.generation = 0
+        self.generation_key = f"{prefix}:generation"
+        # Values are (ttl, payload); the ttu callback turns the ttl into an expiry time
+        self.local = TLRUCache(maxsize=maxsize, ttu=lambda key, value, now: now + value[0])
+    def redis_key(self, generation: int, key: str) -> str:
+        return f"{self.prefix}:{generation}:{key}"
+    async def sync_generation(self) -> int:
+        if self.redis is None:
+            return self.generation
+        before = self.generation
+        try:
+            generation = int(await self.redis.get(self.generation_key) or 0)
+        except RedisError as e:
+            print(f"Cache generation read failed: {e}")
+            return self.generation
+        # A clear() on this worker during the read has already moved past it
+        if self.generation == before:
+            self.generation = generation
+        return self.generation
+    async def get(self, key: str, generation: Optional[int] = None) -> Optional[bytes]:
+        generation = self.generation if generation is None else generation
+        entry = self.local.get((generation, key))
+        if entry is not None:
+            return entry[1]
+        if self.redis is None:
+            return None
+        try:
+            value = await self.redis.get(self.redis_key(generation, key))
+        except RedisError as e:
+            print(f"Cache read failed: {e}")
+            return None
+        if value is not None and generation == self.generation:
+            self.local[(generation, key)] = (self.local_ttl, value)
+        return value
+    async def set(self, key: str, value: bytes, expire: int, generation: Optional[int] = None):
+        if generation is None:
+            generation = self.generation
+        elif generation != self.generation:
+            # Invalidated while the value was being built; storing it would only waste space
+            return
+        self.local[(generation, key)] = (expire if self.redis is None else min(expire, self.local_ttl), value)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(self.redis_key(generation, key), value, ex=expire)
+        except RedisError as e:
+            print(f"Cache write failed: {e}")
+    async def get_or_build(self, key: str, expire: int, build) -> bytes:
+        entry = self.local.get((self.generation, key))
+        if entry is not None:
+            return entry[1]
+        # The generation is read before building, so a response computed while a write
+        # invalidated the cache is filed under the old generation and never served
+        generation = await self.sync_generation()
+        value = await self.get(key, generation)
+        if value is None:
+            value = await build()
+            await self.set(key, value, expire, generation)
+        return value
+    async def clear(self):
+        if self.redis is None:
+            self.generation += 1
+            return
+        try:
+            self.generation = await self.redis.incr(self.generation_key)
+        except RedisError as e:
+            # Other workers can't be told; at least stop serving this worker's copies
+            print(f"Cache clear failed: {e}")
+            self.local.clear()
+
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+# Read responses are cleared on every write. Report conclusions are keyed by a digest of
+# their input and never go stale, so each worker keeps its most recent 256 for the full hour.
+response_cache = ResponseCache(redis_client, prefix="grid")
+report_cache = ResponseCache(redis_client, prefix="report", maxsize=256, local_ttl=3600)
 
 # --- WebSocket Manager ---
+SEND_QUEUE_SIZE = 256
+WS_TRY_AGAIN_LATER = 1013
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    # Every client gets its own bounded queue drained by a dedicated writer task, so
+    # broadcast never waits on a socket and a slow consumer cannot stall the others
+    # or buffer frames without limit.
+    def __init__(self, queue_size: int = SEND_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.active_connections: dict[WebSocket, asyncio.Queue] = {}
+        self.writers: dict[WebSocket, asyncio.Task] = {}
+        self.closing: set[asyncio.Task] = set()
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.active_connections[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self.writer(websocket, queue))
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+    def buffered_amount(self, websocket: WebSocket) -> int:
+        queue = self.active_connections.get(websocket)
+        return queue.qsize() if queue is not None else 0
+    async def writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                await websocket.send_text(await queue.get())
+        except Exception:
+            self.disconnect(websocket)
+    async def close(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        for connection, queue in tuple(self.active_connections.items()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                print(f"Dropping slow WebSocket client with {self.buffered_amount(connection)} frames buffered.")
+                self.disconnect(connection)
+                task = asyncio.create_task(self.close(connection, WS_TRY_AGAIN_LATER))
+                self.closing.add(task)
+                task.add_done_callback(self.closing.discard)
 manager = ConnectionManager()
 
+# Each worker process has its own ConnectionManager, while a /generate job runs on
+# whichever worker accepted the POST. With Redis, frames are published once and every
+# worker's relay delivers them to its own clients; without it there is one process and
+# frames go straight to the local manager.
+BROADCAST_CHANNEL = "grid:broadcast"
+
+async def publish_broadcast(message: str):
+    if redis_client is None:
+        await manager.broadcast(message)
+        return
+    try:
+        await redis_client.publish(BROADCAST_CHANNEL, message)
+    except RedisError as e:
+        # The other workers' clients miss this frame, but this worker's still get it
+        print(f"Broadcast publish failed: {e}")
+        await manager.broadcast(message)
+
+async def relay_broadcasts():
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(BROADCAST_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        await manager.broadcast(message["data"].decode())
+        except RedisError as e:
+            print(f"Broadcast relay lost Redis, resubscribing: {e}")
+            await asyncio.sleep(1)
+
 # --- Existing API Routes ---
-@app.get("/data", response_model=List[GridData], summary="Retrieve latest grid data")
-async def get_grid_data(db: Session = Depends(get_db), limit: int = 100):
-    data = db.query(GridDataModel).order_by(GridDataModel.timestamp.desc()).limit(limit).all()
-    return data
-
-@app.post("/generate", summary="Generate and insert new simulated grid data")
-async def generate_grid_data(db: Session = Depends(get_db), num_records: int = 1):
-    new_records = []
+# Ids are assigned in insertion order, so "newest" walks the primary key backwards
+# with no sort step and no secondary index lookup
+LATEST_QUERY = select(*RECORD_COLUMNS).order_by(GridDataModel.id.desc()).limit(bindparam("limit", type_=Integer))
+
+@app.get(
+    "/data",
+    response_model=List[GridData],
+    summary="Retrieve latest grid data",
+    description=f"Returns the newest records first, capped at {MAX_LIMIT} per request. "
+                "X-Has-More is true when older records exist beyond the limit.",
+)
+async def get_grid_data(
+    db: AsyncSession = Depends(get_db),
+    limit: int = Query(100, ge=1, le=MAX_LIMIT, description=LIMIT_DESCRIPTION),
+):
+    cache_key = f"data:{limit}"
+
+    async def build():
+        records = (await db.execute(LATEST_QUERY, {"limit": limit + 1})).all()
+        headers = {"X-Has-More": "true" if len(records) > limit else "false"}
+        return pack_response(headers, serialize_records(records[:limit]))
+
+    return unpack_response(await response_cache.get_or_build(cache_key, 5, build))
+
+# --- Simulation ---
+rng = np.random.default_rng()
+py_rng = random.Random()
+
+# Batches up to this size are drawn in plain Python: for a handful of readings (the
+# default request is one) the fixed cost of the NumPy calls and .tolist() conversions
+# outweighs the per-record loop.
+SMALL_BATCH = 16
+
+# Roughly 10% of readings are anomalies: voltage outside 210-214V / 246-250V and
+# current above 20A. Both paths draw from the same ranges.
+def simulate_readings(num_records: int) -> list[dict]:
+    if num_records <= SMALL_BATCH:
+        return simulate_readings_small(num_records)
+    return simulate_readings_vectorized(num_records)
+
+def simulate_readings_small(num_records: int) -> list[dict]:
+    draw = py_rng.random
+    timestamp = datetime.now(timezone.utc)
+    rows = []
     for _ in range(num_records):
-        if random.random() < 0.1:
-            voltage = round(random.uniform(210.0, 214.0) if random.random() > 0.5 else random.uniform(246.0, 250.0), 2)
-            current = round(random.uniform(20.1, 30.0), 2)
+        if draw() < 0.1:
+            voltage = (210.0 if draw() > 0.5 else 246.0) + 4.0 * draw()
+            current = 20.1 + 9.9 * draw()
         else:
-            voltage = round(random.uniform(220.0, 240.0), 2)
-            current = round(random.uniform(5.0, 20.0), 2)
-        frequency = round(random.uniform(49.9, 50.1), 2)
-        timestamp = datetime.now(timezone.utc)
-        new_record = GridDataModel(
-            timestamp=timestamp,
-            voltage=voltage,
-            current=current,
-            frequency=frequency
-        )
-        db.add(new_record)
-        new_records.append(new_record)
-    db.commit()
-    for record in new_records:
-        db.refresh(record)
-    
-    for record in new_records:
-        await manager.broadcast(json.dumps(record.__dict__, default=str))
-
-    return {"message": f"Successfully inserted {len(new_records)} new records.", "rows_inserted": len(new_records)}
-
-@app.get("/data/filter", response_model=List[GridData], summary="Retrieve filtered grid data")
+            voltage = 220.0 + 20.0 * draw()
+            current = 5.0 + 15.0 * draw()
+        rows.append({
+            "timestamp": timestamp,
+            "voltage": round(voltage, 2),
+            "current": round(current, 2),
+            "frequency": round(49.9 + 0.2 * draw(), 2),
+        })
+    return rows
+
+# Draws all readings in a handful of vectorized calls
+def simulate_readings_vectorized(num_records: int) -> list[dict]:
+    uniform, draw = rng.uniform, rng.random
+    anomaly = draw(num_records) < 0.1
+    low = draw(num_records) > 0.5
+    # One draw per field, scaled into whichever range each reading falls in, rather than
+    # drawing every candidate range and discarding most of it with np.where
+    voltage_base = np.where(anomaly, np.where(low, 210.0, 246.0), 220.0)
+    voltage_span = np.where(anomaly, 4.0, 20.0)
+    voltage = (voltage_base + voltage_span * draw(num_records)).round(2)
+    current_base = np.where(anomaly, 20.1, 5.0)
+    current_span = np.where(anomaly, 9.9, 15.0)
+    current = (current_base + current_span * draw(num_records)).round(2)
+    frequency = uniform(49.9, 50.1, num_records).round(2)
+    timestamp = datetime.now(timezone.utc)
+    return [
+        {"timestamp": timestamp, "voltage": v, "current": c, "frequency": f}
+        for v, c, f in zip(voltage.tolist(), current.tolist(), frequency.tolist())
+    ]
+
+# A job's simulation and INSERT run on the event loop after the 202 has gone out, so this
+# bounds how long a single /generate can hold up every other route on the worker
+MAX_GENERATE_RECORDS = 10_000
+
+# Runs after the /generate response has been sent. It opens its own session because
+# the request's dependencies have already exited.
+async def run_generation(job_id: str, num_records: int):
+    rows = simulate_readings(num_records)
+    if not rows:
+        return
+    try:
+        async with serialized(), SessionLocal() as db:
+            # A single batched INSERT ... RETURNING instead of one INSERT plus one refresh per
+            # record. It returns the same columns the read paths select, so subscribers get each
+            # record exactly as /data will serve it (e.g. SQLite hands timestamps back naive),
+            # and no ORM objects are hydrated.
+            stmt = insert(GridDataModel).returning(*RECORD_COLUMNS, sort_by_parameter_order=True)
+            records = (await db.execute(stmt, rows)).all()
+            await db.commit()
+    except Exception as e:
+        print(f"Generation job {job_id} failed: {e}")
+        return
+    await response_cache.clear()
+
+    # One frame per job carrying every new record, encoded once for all subscribers
+    await publish_broadcast(
+        orjson.dumps({"type": "batch", "job_id": job_id, "records": [r._asdict() for r in records]}).decode()
+    )
+
+@app.post(
+    "/generate",
+    status_code=202,
+    response_model=GenerationJobResponse,
+    summary="Generate and insert new simulated grid data",
+    description="Queues the generation and returns immediately. The new records are "
+                "broadcast over /ws in a batch frame tagged with the job_id.",
+)
+async def generate_grid_data(
+    background_tasks: BackgroundTasks,
+    num_records: int = Query(1, ge=0, le=MAX_GENERATE_RECORDS, description=f"Records to generate (0-{MAX_GENERATE_RECORDS})."),
+):
+    job_id = uuid.uuid4().hex
+    background_tasks.add_task(run_generation, job_id, num_records)
+    return {"message": f"Generating {num_records} new records.", "job_id": job_id}
+
+# The time-range queries are built once per combination of supplied filters and
+# executed with named parameters, so each variant keeps one statement text (and one
+# cached compiled form / prepared plan) for the life of the process.
+def filter_time_range(query, has_start: bool, has_end: bool):
+    if has_start:
+        query = query.where(GridDataModel.timestamp >= bindparam("start_timestamp", type_=GridDataModel.timestamp.type))
+    if has_end:
+        query = query.where(GridDataModel.timestamp <= bindparam("end_timestamp", type_=GridDataModel.timestamp.type))
+    return query
+
+def time_range_params(start_timestamp: Optional[datetime], end_timestamp: Optional[datetime]) -> dict:
+    params = {}
+    if start_timestamp is not None:
+        params["start_timestamp"] = start_timestamp
+    if end_timestamp is not None:
+        params["end_timestamp"] = end_timestamp
+    return params
+
+def build_filter_query(has_start: bool, has_end: bool, has_cursor: bool):
+    query = filter_time_range(select(*RECORD_COLUMNS), has_start, has_end)
+    if has_cursor:
+        query = query.where(tuple_(GridDataModel.timestamp, GridDataModel.id) < tuple_(
+            bindparam("cursor_timestamp", type_=GridDataModel.timestamp.type),
+            bindparam("cursor_id", type_=Integer),
+        ))
+    return query.order_by(GridDataModel.timestamp.desc(), GridDataModel.id.desc()).limit(bindparam("limit", type_=Integer))
+
+FILTER_QUERIES = {key: build_filter_query(*key) for key in itertools.product((False, True), repeat=3)}
+
+STREAM_QUERIES = {
+    key: filter_time_range(select(*RECORD_COLUMNS), *key).order_by(
+        GridDataModel.timestamp.desc(), GridDataModel.id.desc()
+    ).execution_options(yield_per=1000)
+    for key in itertools.product((False, True), repeat=2)
+}
+
+is_anomaly = or_(
+    GridDataModel.voltage < VOLTAGE_LOW_THRESHOLD,
+    GridDataModel.voltage > VOLTAGE_HIGH_THRESHOLD,
+    GridDataModel.current > CURRENT_HIGH_THRESHOLD,
+)
+STATS_SELECT = select(
+    func.count(GridDataModel.id),
+    func.avg(GridDataModel.voltage),
+    func.min(GridDataModel.voltage),
+    func.max(GridDataModel.voltage),
+    func.avg(GridDataModel.current),
+    func.min(GridDataModel.current),
+    func.max(GridDataModel.current),
+    func.coalesce(func.sum(case((is_anomaly, 1), else_=0)), 0),
+)
+STATS_QUERIES = {key: filter_time_range(STATS_SELECT, *key) for key in itertools.product((False, True), repeat=2)}
+
+# Keyset pagination: the cursor is the (timestamp, id) of the last row on a page,
+# handed to clients as an opaque base64 token in the X-Next-Cursor header.
+def encode_cursor(timestamp: datetime, record_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{record_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        timestamp, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(record_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor.")
+
+@app.get(
+    "/data/filter",
+    response_model=List[GridData],
+    summary="Retrieve filtered grid data",
+    description=f"Returns records in the time range newest first, capped at {MAX_LIMIT} per page. "
+                "When more remain, X-Next-Cursor holds the cursor for the next page.",
+)
 async def filter_grid_data(
-    start_timestamp: Optional[str] = Query(None),
-    end_timestamp: Optional[str] = Query(None),
-    limit: int = 100,
-    db: Session = Depends(get_db)
+    start_timestamp: Optional[datetime] = Query(None),
+    end_timestamp: Optional[datetime] = Query(None),
+    cursor: Optional[str] = Query(None, description="Value of X-Next-Cursor from the previous page."),
+    limit: int = Query(100, ge=1, le=MAX_LIMIT, description=LIMIT_DESCRIPTION),
+    db: AsyncSession = Depends(get_db)
+):
+    # An empty cursor (e.g. ?cursor=) means the first page, like no cursor at all
+    cursor = cursor or None
+    cache_key = f"filter:{start_timestamp}:{end_timestamp}:{cursor}:{limit}"
+
+    async def build():
+        query = FILTER_QUERIES[(start_timestamp is not None, end_timestamp is not None, cursor is not None)]
+        params = time_range_params(start_timestamp, end_timestamp)
+        if cursor is not None:
+            params["cursor_timestamp"], params["cursor_id"] = decode_cursor(cursor)
+        params["limit"] = limit + 1
+        records = (await db.execute(query, params)).all()
+        headers = {"X-Has-More": "false"}
+        if len(records) > limit:
+            records = records[:limit]
+            headers = {"X-Has-More": "true", "X-Next-Cursor": encode_cursor(records[-1].timestamp, records[-1].id)}
+        return pack_response(headers, serialize_records(records))
+
+    return unpack_response(await response_cache.get_or_build(cache_key, 30, build))
+
+@app.get("/data/stream", summary="Stream grid data as newline-delimited JSON")
+async def stream_grid_data(
+    start_timestamp: Optional[datetime] = Query(None),
+    end_timestamp: Optional[datetime] = Query(None),
 ):
-    query = db.query(GridDataModel)
-    if start_timestamp:
-        query = query.filter(GridDataModel.timestamp >= datetime.fromisoformat(start_timestamp.replace('Z', '+00:00')))
-    if end_timestamp:
-        query = query.filter(GridDataModel.timestamp <= datetime.fromisoformat(end_timestamp.replace('Z', '+00:00')))
-    data = query.order_by(GridDataModel.timestamp.desc()).limit(limit).all()
-    return data
+    query = STREAM_QUERIES[(start_timestamp is not None, end_timestamp is not None)]
+    params = time_range_params(start_timestamp, end_timestamp)
+
+    # Rows are pulled through a server-side cursor, so memory stays flat however many
+    # match. Each yield_per batch goes out as one body chunk rather than one per row.
+    # The generator outlives the request's dependencies and owns its session.
+    async def ndjson_lines():
+        async with serialized(), SessionLocal() as db:
+            result = await db.stream(query, params)
+            async for partition in result.partitions():
+                yield b"".join(orjson.dumps(row._asdict()) + b"\n" for row in partition)
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+@app.get("/data/stats", response_model=StatsResponse, summary="Aggregate statistics over a time range")
+async def grid_data_stats(
+    start_timestamp: Optional[datetime] = Query(None),
+    end_timestamp: Optional[datetime] = Query(None),
+    db: AsyncSession = Depends(get_db)
+):
+    cache_key = f"stats:{start_timestamp}:{end_timestamp}"
+
+    async def build():
+        # A single aggregate query; no rows leave the database
+        query = STATS_QUERIES[(start_timestamp is not None, end_timestamp is not None)]
+        row = (await db.execute(query, time_range_params(start_timestamp, end_timestamp))).one()
+        stats = StatsResponse(
+            record_count=row[0],
+            average_voltage=row[1],
+            min_voltage=row[2],
+            max_voltage=row[3],
+            average_current=row[4],
+            min_current=row[5],
+            max_current=row[6],
+            anomalous_records=row[7],
+        )
+        return pack_response({}, stats.model_dump_json().encode())
+
+    return unpack_response(await response_cache.get_or_build(cache_key, 30, build))
 
 @app.delete("/data", summary="Delete all grid data records")
-async def delete_all_data(db: Session = Depends(get_db)):
-    db.query(GridDataModel).delete()
-    db.commit()
+async def delete_all_data(db: AsyncSession = Depends(get_db)):
+    await db.execute(delete(GridDataModel))
+    await db.commit()
+    await response_cache.clear()
     return {"message": "All grid data records have been deleted."}
 
-@app.post("/report")
-async def generate_report(records: List[GridData] = Body(...)):
-    if not model:
-        raise HTTPException(status_code=500, detail="AI model is not configured. Please check GEMINI_API_KEY.")
-    if not records:
-        raise HTTPException(status_code=400, detail="No data provided to generate a report.")
-    
-    records_dict = [record.model_dump() for record in records]
-    prompt = f"""
-    You are a smart grid data analyst. I will provide you with a list of smart grid sensor readings in JSON format.
-    Your task is to analyze this data and generate a professional, well-structured report.
+# --- Report Prompt ---
+# Sections 1-3 of the report are rendered locally from the computed figures; the model
+# only writes the conclusion. Both templates are built once at import.
+REPORT_SECTIONS_TEMPLATE = f"""# Smart Grid Analysis Report
 
-    The data contains the following fields: 'id', 'timestamp', 'voltage', 'current', and 'frequency'.
+## 1. Overview
+- **Records analyzed:** {{record_count}}
+- **Time range:** {{start_time}} to {{end_time}}
 
-    The report should include the following sections, formatted using Markdown:
+## 2. Key Metrics
+- **Average Voltage:** {{average_voltage:.2f}} V
+- **Average Current:** {{average_current:.2f}} A
+- **Peak Values:** {{max_voltage:.2f}} V voltage, {{max_current:.2f}} A current
+- **Min Values:** {{min_voltage:.2f}} V voltage, {{min_current:.2f}} A current
 
-    # Smart Grid Analysis Report
+## 3. Anomaly Detection
+- Anomaly thresholds: voltage below {VOLTAGE_LOW_THRESHOLD:g}V or above {VOLTAGE_HIGH_THRESHOLD:g}V; current above {CURRENT_HIGH_THRESHOLD:g}A.
+- **Voltage anomalies:** {{voltage_anomalies}}
+- **Current anomalies:** {{current_anomalies}}
+- **Records with any anomaly:** {{anomalous_records}} of {{record_count}} ({{anomaly_percent:.1f}}%)
 
-    ## 1. Overview
-    - Provide a high-level summary of the data, including the total number of records analyzed and the time range covered.
+"""
 
-    ## 2. Key Metrics
-    - **Average Voltage:** The average voltage across all records.
-    - **Average Current:** The average current across all records.
-    - **Peak Values:** The maximum voltage and maximum current recorded.
-    - **Min Values:** The minimum voltage and minimum current recorded.
+REPORT_PROMPT_HEADER = f"""
+    You are a smart grid data analyst. I will provide you with approximate summary statistics of smart grid sensor readings, in JSON format.
+    The overview, key metrics, and anomaly counts have already been written into the report; your task is to write only its final section.
 
-    ## 3. Anomaly Detection
-    - Anomaly thresholds are defined as:
-        - Voltage: below 215V or above 245V.
-        - Current: above 20A.
-    - Analyze the data to identify and count any records that fall outside these thresholds.
-    - Provide a summary of the anomalies detected.
+    The anomaly thresholds are: voltage below {VOLTAGE_LOW_THRESHOLD:g}V or above {VOLTAGE_HIGH_THRESHOLD:g}V, and current above {CURRENT_HIGH_THRESHOLD:g}A.
+    Percentages are shares of all records; voltages are in V and currents in A, rounded.
 
-    ## 4. Conclusion & Recommendations
+    Write the section in Markdown, starting with the heading "## 4. Conclusion & Recommendations":
     - Conclude with an overall assessment of the grid's stability during the analyzed period.
     - Provide a brief recommendation based on the findings (e.g., "The grid appears stable" or "Further investigation into the voltage fluctuations is recommended").
+    Keep it to a short paragraph and at most three bullet points. Describe the figures qualitatively and do not restate exact numbers.
 
-    Here is the data in JSON format:
+    Here is the summary in JSON format:
 
-    {json.dumps(records_dict, indent=2, default=str)}
     """
+
+# Computes the report's figures in a few vectorized passes over the readings. The result
+# is independent of record order and every float is rounded to 2 dp.
+def summarize_records(records: List[GridData]) -> dict:
+    voltage = np.fromiter((r.voltage for r in records), dtype=np.float64, count=len(records))
+    current = np.fromiter((r.current for r in records), dtype=np.float64, count=len(records))
+    voltage_anomaly = (voltage < VOLTAGE_LOW_THRESHOLD) | (voltage > VOLTAGE_HIGH_THRESHOLD)
+    current_anomaly = current > CURRENT_HIGH_THRESHOLD
+    # Records may mix naive timestamps (as SQLite stores them) with offset-aware ones posted
+    # by clients; naive values are taken as UTC so they can be compared
+    timestamps = [r.timestamp if r.timestamp.tzinfo else r.timestamp.replace(tzinfo=timezone.utc) for r in records]
+    return {
+        "record_count": len(records),
+        "start_time": min(timestamps).isoformat(),
+        "end_time": max(timestamps).isoformat(),
+        "average_voltage": round(float(voltage.mean()), 2),
+        "min_voltage": round(float(voltage.min()), 2),
+        "max_voltage": round(float(voltage.max()), 2),
+        "average_current": round(float(current.mean()), 2),
+        "min_current": round(float(current.min()), 2),
+        "max_current": round(float(current.max()), 2),
+        "voltage_anomalies": int(voltage_anomaly.sum()),
+        "current_anomalies": int(current_anomaly.sum()),
+        "anomalous_records": int((voltage_anomaly | current_anomaly).sum()),
+    }
+
+def render_report_sections(summary: dict) -> str:
+    anomaly_percent = 100 * summary["anomalous_records"] / summary["record_count"]
+    return REPORT_SECTIONS_TEMPLATE.format(anomaly_percent=anomaly_percent, **summary)
+
+# Bucketed view of the summary that the conclusion is written from. Windows whose figures
+# land in the same buckets read the same qualitatively, so they share one cached
+# conclusion (a near-miss hit); the exact figures always come from render_report_sections.
+def coarse_summary(summary: dict) -> dict:
+    count = summary["record_count"]
+    return {
+        "record_count_order": f"{2 ** (count.bit_length() - 1)}-{2 ** count.bit_length() - 1}",
+        "average_voltage": round(summary["average_voltage"]),
+        "voltage_range": [round(summary["min_voltage"]), round(summary["max_voltage"])],
+        "average_current": round(summary["average_current"] * 2) / 2,
+        "current_range": [round(summary["min_current"]), round(summary["max_current"])],
+        "voltage_anomaly_percent": round(100 * summary["voltage_anomalies"] / count),
+        "current_anomaly_percent": round(100 * summary["current_anomalies"] / count),
+        "anomalous_record_percent": round(100 * summary["anomalous_records"] / count),
+    }
+
+# Upper bound on a single Gemini call, and on each chunk of a streamed one, so a stalled
+# upstream request doesn't pin a worker or hold the client's connection open
+REPORT_TIMEOUT_SECONDS = 30
+
+# Appended to a streamed report whose conclusion failed part way; the 200 status has
+# already been sent, so the body is the only place left to say so
+REPORT_STREAM_FAILED = "\n\n_The conclusion could not be completed ({reason}). Please generate the report again._\n"
+
+# Sends the locally rendered sections straight away, then forwards the conclusion as
+# Gemini produces it, caching the conclusion once complete
+async def stream_report_chunks(sections: str, response, cache_key: str):
+    yield sections
+    parts = []
+    chunks = aiter(response)
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), timeout=REPORT_TIMEOUT_SECONDS)
+            except StopAsyncIteration:
+                break
+            parts.append(chunk.text)
+            yield chunk.text
+    except asyncio.TimeoutError:
+        print("Report stream timed out.")
+        yield REPORT_STREAM_FAILED.format(reason="timed out waiting for the AI")
+        return
+    except Exception as e:
+        print(f"Report stream failed: {e}")
+        yield REPORT_STREAM_FAILED.format(reason="the AI request failed")
+        return
+    conclusion = "".join(parts)
+    if not conclusion.strip():
+        yield REPORT_STREAM_FAILED.format(reason="the AI returned no text")
+        return
+    await report_cache.set(cache_key, conclusion.encode(), expire=3600)
+
+# Returning ORJSONResponse directly rather than a dict skips FastAPI's jsonable_encoder
+# pass over the payload; orjson encodes it in one step.
+@app.post("/report")
+async def generate_report(
+    records: List[GridData] = Body(...),
+    stream: bool = Query(False, description="Stream the report as plain text while it is being generated."),
+):
+    if not model:
+        raise HTTPException(status_code=500, detail="AI model is not configured. Please check GEMINI_API_KEY.")
+    if not records:
+        raise HTTPException(status_code=400, detail="No data provided to generate a report.")
+
+    summary = summarize_records(records)
+    sections = render_report_sections(summary)
+    coarse_json = orjson.dumps(coarse_summary(summary))
+    # The coarse summary is the only per-request part of the prompt, so it identifies the conclusion
+    cache_key = hashlib.blake2b(coarse_json).hexdigest()
+    cached = await report_cache.get(cache_key)
+    if cached is not None:
+        if stream:
+            return Response(content=sections + cached.decode(), media_type="text/plain; charset=utf-8")
+        return ORJSONResponse({"report": sections + cached.decode()})
+
+    prompt = REPORT_PROMPT_HEADER + coarse_json.decode()
     try:
-        response = model.generate_content(prompt)
-        return {"report": response.text}
+        response = await asyncio.wait_for(
+            model.generate_content_async(prompt, stream=stream), timeout=REPORT_TIMEOUT_SECONDS
+        )
+        if stream:
+            return StreamingResponse(
+                stream_report_chunks(sections, response, cache_key),
+                media_type="text/plain; charset=utf-8",
+                headers=UNCOMPRESSED_STREAM_HEADERS,
+            )
+        if response.text.strip():
+            await report_cache.set(cache_key, response.text.encode(), expire=3600)
+        return ORJSONResponse({"report": sections + response.text})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timed out waiting for the AI report.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate report with AI: {e}")
 
@@ -250,14 +899,44 @@ async def websocket_endpoint(websocket: WebSocket):
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
         print("WebSocket disconnected.")
+    finally:
+        # Also stops the client's writer task when receiving fails for any other reason
+        manager.disconnect(websocket)
+
+# --- Health Check ---
+HEALTH_CHECK_INTERVAL = 10
+
+async def ping_database():
+    async with serialized(), engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+# Load balancers probe /health every few seconds; the database round trip is made at
+# most once per interval and the outcome (success or error) is reused in between.
+class HealthCheck:
+    def __init__(self, ping, interval: float = HEALTH_CHECK_INTERVAL):
+        self.ping = ping
+        self.interval = interval
+        self.checked_at: Optional[float] = None
+        self.error: Optional[Exception] = None
+        self.lock = asyncio.Lock()
+    async def check(self) -> Optional[Exception]:
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            if self.checked_at is None or now - self.checked_at >= self.interval:
+                try:
+                    await self.ping()
+                    self.error = None
+                except Exception as e:
+                    self.error = e
+                self.checked_at = now
+            return self.error
+health = HealthCheck(ping_database)
 
 @app.get("/health", summary="Health check endpoint")
-async def health_check(db: Session = Depends(get_db)):
-    try:
-        db.execute(text("SELECT 1"))
-        return {"status": "healthy", "database_connection": "ok"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Service unhealthy: {e}")
+async def health_check():
+    error = await health.check()
+    if error is not None:
+        raise HTTPException(status_code=500, detail=f"Service unhealthy: {error}")
+    return ORJSONResponse({"status": "healthy", "database_connection": "ok"})
 
@@ -1,61 +1,193 @@
+import json
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from main import app, get_db_connection
-import psycopg2
-import os
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-
-# Use a temporary test database for isolation
-def setup_test_database():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST", "db"),
-            database=os.getenv("POSTGRES_DB", "grid_db"),
-            user=os.getenv("POSTGRES_USER", "user"),
-            password=os.getenv("POSTGRES_PASSWORD", "password")
-        )
-        return conn
-    except psycopg2.Error as e:
-        print(f"Test database connection error: {e}")
-        return None
+import main
+from main import app
 
 @pytest.fixture(scope="module")
 def client():
     with TestClient(app) as client:
         # Set up the test environment before tests
-        conn = setup_test_database()
-        if conn:
-            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            cur = conn.cursor()
-            cur.execute("DELETE FROM grid_data") # Clean up before each test run
-            cur.close()
-            conn.close()
+        client.delete("/data") # Clean up before each test run
 
         yield client
 
         # Clean up after tests
-        conn = setup_test_database()
-        if conn:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM grid_data")
-            cur.close()
-            conn.close()
+        client.delete("/data")
+
+@pytest.mark.parametrize("url, expected", [
+    ("postgres://user:pw@db/grid_db", "postgresql+asyncpg://user:pw@db/grid_db"),
+    ("postgresql+psycopg2://user:pw@db/grid_db", "postgresql+asyncpg://user:pw@db/grid_db"),
+    ("postgresql+asyncpg://user:pw@db/grid_db", "postgresql+asyncpg://user:pw@db/grid_db"),
+    ("sqlite:///./grid.db", "sqlite+aiosqlite:///./grid.db"),
+    ("sqlite+aiosqlite:///:memory:", "sqlite+aiosqlite:///:memory:"),
+])
+def test_to_async_database_url(url, expected):
+    assert main.to_async_database_url(url) == expected
+
+def test_sqlite_file_engine_uses_wal(tmp_path):
+    engine = main.make_engine(f"sqlite+aiosqlite:///{tmp_path / 'grid.db'}")
+
+    async def pragmas():
+        async with engine.connect() as conn:
+            journal_mode = await conn.scalar(main.text("PRAGMA journal_mode"))
+            synchronous = await conn.scalar(main.text("PRAGMA synchronous"))
+        await engine.dispose()
+        return journal_mode, synchronous
+
+    # synchronous=NORMAL is reported as 1
+    assert asyncio.run(pragmas()) == ("wal", 1)
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.published = []
+    async def get(self, key):
+        return self.values.get(key)
+    async def set(self, key, value, ex=None):
+        self.values[key] = value if isinstance(value, bytes) else str(value).encode()
+    async def incr(self, key):
+        value = int(self.values.get(key, 0)) + 1
+        self.values[key] = str(value).encode()
+        return value
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+@pytest.mark.parametrize("redis", [None, FakeRedis()], ids=["local", "redis"])
+def test_response_cache_versioned_invalidation(redis):
+    cache = main.ResponseCache(redis)
+    builds = []
+
+    async def build():
+        builds.append(1)
+        return b"payload"
+
+    async def build_during_write():
+        # A write lands while this response is being computed
+        await cache.clear()
+        return b"stale"
+
+    async def scenario():
+        assert await cache.get_or_build("key", 30, build) == b"payload"
+        assert await cache.get_or_build("key", 30, build) == b"payload"
+        assert len(builds) == 1
+        await cache.clear()
+        assert await cache.get_or_build("key", 30, build) == b"payload"
+        assert len(builds) == 2
+
+        await cache.get_or_build("other", 30, build_during_write)
+        assert await cache.get("other") is None
+
+    asyncio.run(scenario())
+
+def test_memory_sqlite_sessions_do_not_roll_back_each_other(monkeypatch):
+    engine = main.make_engine("sqlite+aiosqlite:///:memory:")
+    sessions = main.async_sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(main, "db_lock", asyncio.Lock())
+    rows = main.simulate_readings(5)
+
+    async def write():
+        async with main.serialized(), sessions() as db:
+            stmt = main.insert(main.GridDataModel).returning(main.GridDataModel.id)
+            assert len((await db.execute(stmt, rows)).all()) == 5
+            await asyncio.sleep(0.01)
+            await db.commit()
+
+    async def read():
+        # A /data poll finishing mid-transaction returns the shared connection to the pool
+        async with main.serialized(), sessions() as db:
+            await db.execute(main.LATEST_QUERY, {"limit": 10})
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(main.Base.metadata.create_all)
+        await asyncio.gather(write(), read())
+        async with sessions() as db:
+            count = await db.scalar(main.select(main.func.count()).select_from(main.GridDataModel))
+        await engine.dispose()
+        return count
+
+    assert asyncio.run(scenario()) == 5
+
+def test_response_cache_clear_reaches_other_workers():
+    redis = FakeRedis()
+    # local_ttl=0 so each lookup goes to the shared Redis tier
+    first, second = main.ResponseCache(redis, local_ttl=0), main.ResponseCache(redis, local_ttl=0)
+
+    async def build_old():
+        return b"old"
+
+    async def build_new():
+        return b"new"
+
+    async def scenario():
+        assert await first.get_or_build("key", 30, build_old) == b"old"
+        assert await second.get_or_build("key", 30, build_new) == b"old"
+        await second.clear()
+        assert await first.get_or_build("key", 30, build_new) == b"new"
+
+    asyncio.run(scenario())
+
+def test_summarize_records_is_normalized():
+    records = [
+        main.GridData(id=1, timestamp="2024-01-01T00:00:00Z", voltage=230.004, current=10.0, frequency=50.0),
+        main.GridData(id=2, timestamp="2024-01-01T00:01:00Z", voltage=231.0, current=12.0, frequency=50.0),
+    ]
+    # Same readings in another order and with sub-display precision noise
+    shuffled = [records[1], records[0].model_copy(update={"voltage": 230.0})]
+    assert main.summarize_records(records) == main.summarize_records(shuffled)
 
 def test_health_check(client):
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "healthy", "database_connection": "ok"}
 
+def test_health_check_reuses_recent_ping():
+    calls = []
+    async def ping():
+        calls.append(1)
+        if len(calls) > 1:
+            raise RuntimeError("database down")
+
+    async def scenario():
+        check = main.HealthCheck(ping, interval=60)
+        assert await check.check() is None
+        assert await check.check() is None
+        check.interval = 0
+        assert str(await check.check()) == "database down"
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+def test_generate_caps_num_records(client):
+    response = client.post("/generate", params={"num_records": main.MAX_GENERATE_RECORDS + 1})
+    assert response.status_code == 422
+
 def test_generate_data(client):
     response = client.post("/generate", params={"num_records": 5})
-    assert response.status_code == 200
-    assert response.json()["rows_inserted"] == 5
+    assert response.status_code == 202
+    assert response.json()["job_id"]
 
     # Verify data was inserted
     data_response = client.get("/data", params={"limit": 10})
     assert data_response.status_code == 200
     assert len(data_response.json()) >= 5
 
+@pytest.mark.parametrize("num_records", [1000, main.SMALL_BATCH])
+def test_simulate_readings(num_records):
+    # SMALL_BATCH takes the plain-Python path, 1000 the vectorized one
+    rows = main.simulate_readings(num_records)
+    assert len(rows) == num_records
+    for row in rows:
+        assert 210.0 <= row["voltage"] <= 250.0
+        assert 5.0 <= row["current"] <= 30.0
+        assert 49.9 <= row["frequency"] <= 50.1
+        # Anomalous voltages always come with anomalous current, as in the original simulation
+        if row["voltage"] < 215 or row["voltage"] > 245:
+            assert row["current"] > 20
+    assert main.simulate_readings(0) == []
+
 def test_delete_all_data(client):
     # First, generate some data
     client.post("/generate", params={"num_records": 1})
@@ -85,4 +217,285 @@ def test_filter_data(client):
 
     assert response.status_code == 200
     # Check if the number of filtered records is correct
-    assert len(response.json()) > 0
\ No newline at end of file
+    assert len(response.json()) > 0
+
+def test_filter_data_rejects_invalid_timestamp(client):
+    response = client.get("/data/filter", params={"start_timestamp": "not-a-date"})
+    assert response.status_code == 422
+
+def test_filter_data_cursor_pagination(client):
+    client.delete("/data")
+    client.post("/generate", params={"num_records": 7})
+
+    seen = []
+    params = {"limit": 3}
+    while True:
+        response = client.get("/data/filter", params=params)
+        assert response.status_code == 200
+        seen.extend(record["id"] for record in response.json())
+        next_cursor = response.headers.get("X-Next-Cursor")
+        if not next_cursor:
+            break
+        params = {"limit": 3, "cursor": next_cursor}
+
+    # Every record is returned exactly once, newest first
+    assert len(seen) == 7
+    assert seen == sorted(seen, reverse=True)
+
+def test_filter_data_rejects_invalid_cursor(client):
+    response = client.get("/data/filter", params={"cursor": "bogus"})
+    assert response.status_code == 400
+
+def test_filter_data_treats_empty_cursor_as_first_page(client):
+    response = client.get("/data/filter", params={"cursor": ""})
+    assert response.status_code == 200
+    assert response.json() == client.get("/data/filter").json()
+
+def test_stream_data(client):
+    client.delete("/data")
+    client.post("/generate", params={"num_records": 4})
+
+    response = client.get("/data/stream")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 4
+    assert json.loads(lines[0]).keys() == {"id", "timestamp", "voltage", "current", "frequency"}
+
+def test_data_limit_is_capped(client):
+    assert client.get("/data", params={"limit": 1001}).status_code == 422
+    assert client.get("/data", params={"limit": 0}).status_code == 422
+    assert client.get("/data/filter", params={"limit": 1001}).status_code == 422
+
+def test_data_is_gzipped(client):
+    client.delete("/data")
+    client.post("/generate", params={"num_records": 50})
+
+    response = client.get("/data", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 50
+
+def test_data_has_more_header(client):
+    client.delete("/data")
+    client.post("/generate", params={"num_records": 3})
+
+    assert client.get("/data", params={"limit": 2}).headers["X-Has-More"] == "true"
+    assert client.get("/data", params={"limit": 3}).headers["X-Has-More"] == "false"
+
+class FakeSocket:
+    def __init__(self, fail=False, stalled=False):
+        self.fail = fail
+        self.stalled = stalled
+        self.messages = []
+        self.close_code = None
+    async def accept(self):
+        pass
+    async def send_text(self, message):
+        if self.fail:
+            raise RuntimeError("connection closed")
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.messages.append(message)
+    async def close(self, code=1000):
+        self.close_code = code
+
+def test_broadcast_drops_failed_sockets():
+    async def scenario():
+        manager = main.ConnectionManager()
+        healthy, dead = FakeSocket(), FakeSocket(fail=True)
+        await manager.connect(healthy)
+        await manager.connect(dead)
+
+        await manager.broadcast("frame")
+        await asyncio.sleep(0)
+        # The dead socket neither blocks delivery nor stays registered
+        assert healthy.messages == ["frame"]
+        assert set(manager.active_connections) == {healthy}
+
+    asyncio.run(scenario())
+
+def test_broadcast_drops_slow_consumers():
+    async def scenario():
+        manager = main.ConnectionManager(queue_size=2)
+        healthy, slow = FakeSocket(), FakeSocket(stalled=True)
+        await manager.connect(healthy)
+        await manager.connect(slow)
+
+        for i in range(4):
+            await manager.broadcast(f"frame-{i}")
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        # The stalled client overflows its queue and is closed with "Try Again Later"
+        assert healthy.messages == [f"frame-{i}" for i in range(4)]
+        assert set(manager.active_connections) == {healthy}
+        assert slow.close_code == main.WS_TRY_AGAIN_LATER
+
+    asyncio.run(scenario())
+
+def test_broadcast_goes_through_redis_when_configured(monkeypatch):
+    redis = FakeRedis()
+    local = []
+    monkeypatch.setattr(main, "redis_client", redis)
+    monkeypatch.setattr(main.manager, "broadcast", lambda message: local.append(message))
+
+    asyncio.run(main.publish_broadcast("frame"))
+    # Every worker's relay, including this one's, delivers the published frame
+    assert redis.published == [(main.BROADCAST_CHANNEL, "frame")]
+    assert local == []
+
+def test_generate_broadcasts_to_websocket(client):
+    with client.websocket_connect("/ws") as websocket:
+        job_id = client.post("/generate", params={"num_records": 3}).json()["job_id"]
+        message = json.loads(websocket.receive_text())
+        assert message["type"] == "batch"
+        assert message["job_id"] == job_id
+        assert len(message["records"]) == 3
+        assert message["records"][0].keys() == {"id", "timestamp", "voltage", "current", "frequency"}
+
+        # Broadcast records are the stored rows, formatted exactly as /data serves them
+        stored = {record["id"]: record for record in client.get("/data").json()}
+        for record in message["records"]:
+            assert stored[record["id"]] == record
+    # Leaving the socket unregisters it and stops its writer task
+    assert not main.manager.active_connections and not main.manager.writers
+
+def test_data_stats(client):
+    client.delete("/data")
+    assert client.get("/data/stats").json()["record_count"] == 0
+
+    client.post("/generate", params={"num_records": 20})
+    records = client.get("/data").json()
+    stats = client.get("/data/stats").json()
+
+    voltages = [r["voltage"] for r in records]
+    anomalies = [r for r in records if r["voltage"] < 215 or r["voltage"] > 245 or r["current"] > 20]
+    assert stats["record_count"] == 20
+    assert stats["min_voltage"] == pytest.approx(min(voltages))
+    assert stats["max_voltage"] == pytest.approx(max(voltages))
+    assert stats["average_voltage"] == pytest.approx(sum(voltages) / len(voltages))
+    assert stats["anomalous_records"] == len(anomalies)
+
+CONCLUSION = "## 4. Conclusion & Recommendations\nThe grid appears stable."
+
+# Streamed chunks are text, an exception to raise, or STALL to hang like a dead upstream
+STALL = object()
+
+class FakeReportModel:
+    def __init__(self):
+        self.prompts = []
+        self.chunks = (CONCLUSION[:20], CONCLUSION[20:])
+    async def generate_content_async(self, prompt, stream=False):
+        self.prompts.append(prompt)
+        if stream:
+            return self.stream_chunks()
+        return type("FakeResponse", (), {"text": CONCLUSION})()
+    async def stream_chunks(self):
+        for text in self.chunks:
+            if text is STALL:
+                await asyncio.Event().wait()
+            if isinstance(text, Exception):
+                raise text
+            yield type("FakeChunk", (), {"text": text})()
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    fake = FakeReportModel()
+    monkeypatch.setattr(main, "model", fake)
+    monkeypatch.setattr(main, "report_cache", main.ResponseCache())
+    return fake
+
+def report_records(voltages):
+    return [
+        {"id": i, "timestamp": f"2024-01-01T00:0{i}:00Z", "voltage": v, "current": 10.0 + i, "frequency": 50.0}
+        for i, v in enumerate(voltages)
+    ]
+
+def test_generate_report(client, fake_model):
+    response = client.post("/report", json=report_records([230.0, 250.0, 232.0]))
+    assert response.status_code == 200
+    report = response.json()["report"]
+    # Figures are rendered locally; the model only contributes the conclusion
+    assert report.startswith("# Smart Grid Analysis Report")
+    assert "- **Average Voltage:** 237.33 V" in report
+    assert "- **Records with any anomaly:** 1 of 3 (33.3%)" in report
+    assert report.endswith(CONCLUSION)
+    # Only the coarse summary is sent, not the raw readings
+    assert len(fake_model.prompts) == 1
+    assert '"anomalous_record_percent":33' in fake_model.prompts[0]
+    assert '"id"' not in fake_model.prompts[0]
+
+def test_summarize_records():
+    records = [
+        main.GridData(id=1, timestamp="2024-01-01T00:00:00Z", voltage=230.0, current=10.0, frequency=50.0),
+        main.GridData(id=2, timestamp="2024-01-01T00:01:00Z", voltage=250.0, current=25.0, frequency=50.0),
+        main.GridData(id=3, timestamp="2024-01-01T00:02:00Z", voltage=210.0, current=12.0, frequency=50.0),
+    ]
+    summary = main.summarize_records(records)
+    assert summary["record_count"] == 3
+    assert summary["average_voltage"] == 230.0
+    assert summary["max_current"] == 25.0
+    assert summary["voltage_anomalies"] == 2
+    assert summary["current_anomalies"] == 1
+    assert summary["anomalous_records"] == 2
+
+def test_generate_report_mixes_stored_and_live_records(client, fake_model):
+    with client.websocket_connect("/ws") as websocket:
+        client.post("/generate", params={"num_records": 1})
+        live = json.loads(websocket.receive_text())["records"]
+    stored = client.get("/data").json()
+    # Records as the dashboard collects them: stored rows, WebSocket rows and an aware timestamp
+    records = stored + live + report_records([230.0])
+
+    response = client.post("/report", json=records)
+    assert response.status_code == 200
+    assert response.json()["report"].endswith(CONCLUSION)
+
+def test_generate_report_is_cached(client, fake_model):
+    records = report_records([230.0, 231.0])
+    first = client.post("/report", json=records)
+    second = client.post("/report", json=records)
+    assert first.json() == second.json()
+    # The repeat request is served from the cache without calling the model
+    assert len(fake_model.prompts) == 1
+
+def test_generate_report_reuses_conclusion_for_similar_data(client, fake_model):
+    first = client.post("/report", json=report_records([230.2, 231.2])).json()["report"]
+    second = client.post("/report", json=report_records([230.3, 231.3])).json()["report"]
+    # Qualitatively identical windows share the cached conclusion, but keep their own figures
+    assert len(fake_model.prompts) == 1
+    assert "230.70 V" in first and "230.80 V" in second
+    assert first.endswith(CONCLUSION) and second.endswith(CONCLUSION)
+
+def test_generate_report_stream(client, fake_model):
+    records = report_records([230.0, 231.0])
+    response = client.post("/report", params={"stream": "true"}, json=records)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    # Left uncompressed so the chunks aren't held back by GZip
+    assert response.headers["content-encoding"] == "identity"
+    assert response.text.startswith("# Smart Grid Analysis Report")
+    assert response.text.endswith(CONCLUSION)
+
+    # The streamed conclusion is cached for both response forms
+    assert client.post("/report", json=records).json() == {"report": response.text}
+    assert len(fake_model.prompts) == 1
+
+@pytest.mark.parametrize("chunks", [
+    (CONCLUSION[:20], RuntimeError("connection reset")),
+    (CONCLUSION[:20], STALL),
+    (),
+], ids=["error", "stall", "empty"])
+def test_generate_report_stream_failure(client, fake_model, monkeypatch, chunks):
+    monkeypatch.setattr(main, "REPORT_TIMEOUT_SECONDS", 0.1)
+    fake_model.chunks = chunks
+    records = report_records([230.0, 231.0])
+
+    response = client.post("/report", params={"stream": "true"}, json=records)
+    # The failure is reported at the end of the body, and nothing is cached
+    assert "could not be completed" in response.text
+    client.post("/report", params={"stream": "true"}, json=records)
+    assert len(fake_model.prompts) == 2
+
+def test_generate_report_requires_records(client, fake_model):
+    response = client.post("/report", json=[])
+    assert response.status_code == 400
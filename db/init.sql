@@ -12,6 +12,11 @@ CREATE TABLE grid_data (
     frequency REAL -- NO COMMA HERE!
 );
 
+-- Newest-first index: turns ORDER BY timestamp DESC, id DESC LIMIT n into a
+-- bounded index scan and serves the /data/filter time-range and cursor lookups.
+-- Keep in sync with the Index on GridDataModel in backend/main.py.
+CREATE INDEX IF NOT EXISTS idx_grid_data_ts_desc ON grid_data (timestamp DESC, id DESC);
+
 -- Optional: Insert some initial dummy data for testing purposes
 INSERT INTO grid_data (voltage, current, frequency) VALUES
 (230.1, 10.5, 50.0),
@@ -146,9 +146,11 @@ const App: React.FC = () => {
     };
 
     ws.current.onmessage = (event) => {
-      const newData: GridData = JSON.parse(event.data);
+      // /generate sends one batch frame per call; older servers send one record per frame
+      const message = JSON.parse(event.data);
+      const newData: GridData[] = message.type === 'batch' ? message.records : [message];
       setData(prevData => {
-        const updatedData = [...prevData, newData].sort((a, b) => new Date(a.timestamp).getTime() - new Date(b.timestamp).getTime());
+        const updatedData = [...prevData, ...newData].sort((a, b) => new Date(a.timestamp).getTime() - new Date(b.timestamp).getTime());
         return updatedData;
       });
     };
@@ -271,7 +273,7 @@ const App: React.FC = () => {
     setIsReportGenerating(true);
     try {
       const apiUrl = process.env.REACT_APP_API_URL || '';
-      const response = await fetch(`${apiUrl}/report`, {
+      const response = await fetch(`${apiUrl}/report?stream=true`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -280,8 +282,17 @@ const App: React.FC = () => {
       });
 
       if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-      const result = await response.json();
-      setReportContent(result.report);
+      if (!response.body) throw new Error('Streaming responses are not supported by this browser.');
+      // The computed sections arrive first, then the AI conclusion as it is generated
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let report = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        report += decoder.decode(value, { stream: true });
+        setReportContent(report);
+      }
     } catch (e: any) {
       alert("Failed to generate report: " + e.message);
       console.error("Error generating report:", e);